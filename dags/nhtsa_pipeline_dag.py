@@ -1,13 +1,15 @@
 """
 NHTSA Data Pipeline DAG
-Simple 3-stage pipeline using functions from src/code/nhtsa_file_parser.py
+Simple multi-stage pipeline using functions from src/code/nhtsa_file_parser.py
 """
 
 from datetime import datetime, timedelta
 from airflow import DAG
+from airflow.decorators import task_group
 from airflow.operators.python import PythonOperator
 from airflow.providers.postgres.hooks.postgres import PostgresHook
-import json
+import csv
+import io
 import os
 import sys
 import pandas as pd
@@ -17,7 +19,9 @@ from sqlalchemy import text
 sys.path.append('/opt/airflow/src/code')
 
 # Import our parser functions directly
-from nhtsa_file_parser import write_to_bronze, write_to_silver
+from nhtsa_file_parser import (
+    SILVER_PART_FILE, plan_partitions, remove_plain_source, validate_silver_partition, write_bronze_and_silver,
+)
 
 # Default arguments for the DAG
 default_args = {
@@ -30,6 +34,29 @@ default_args = {
     'retry_delay': timedelta(minutes=5),
 }
 
+# Number of bronze partitions loaded in parallel (capped by the nhtsa_cpu pool)
+BRONZE_PARTITIONS = 4
+# Parse processes per bronze task - the partitions running together share the CPUs
+PARSE_WORKERS_PER_PARTITION = max(1, (os.cpu_count() or 1) // BRONZE_PARTITIONS)
+
+# Silver layer fields mapped to processed_nhtsa_data columns, in table order
+SILVER_TO_DB_COLUMNS = {
+    'Sent_VIN': 'sent_vin',
+    'Manufacturer_Name': 'manufacturer_name',
+    'Make': 'make',
+    'Model': 'model',
+    'Model_Year': 'model_year',
+    'TRIM': 'trim',
+    'Vehicle_Type_Id': 'vehicle_type_id',
+    'Body_Class_Id': 'body_class_id',
+    'Base_Price': 'base_price',
+    'NCSA_Make': 'ncsa_make',
+    'NCSA_Model': 'ncsa_model',
+}
+
+# NULL marker for COPY - keeps real empty strings as '' instead of NULL
+COPY_NULL = r'\N'
+
 # DAG definition
 dag = DAG(
     'nhtsa_data_pipeline',
@@ -40,150 +67,236 @@ dag = DAG(
     tags=['nhtsa', 'automotive', 'data-pipeline'],
 )
 
-def task_bronze(**context):
-    """Task 1: Load to Bronze layer using our parser function"""
-    write_to_bronze()
+def psql_copy(table, conn, keys, data_iter):
+    """pandas to_sql method that streams all rows through one COPY instead of one INSERT per row"""
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerows([COPY_NULL if value is None else value for value in row] for row in data_iter)
+    buf.seek(0)
+    
+    table_name = f'{table.schema}.{table.name}' if table.schema else table.name
+    columns = ', '.join(keys)
+    with conn.connection.cursor() as cursor:
+        cursor.copy_expert(
+            f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buf
+        )
+
+def task_plan_bronze(**context):
+    """Task 0: Decompress the source once and split it into byte ranges, one per bronze task"""
+    return plan_partitions(BRONZE_PARTITIONS)
+
+def task_bronze(partition, start, end, **context):
+    """Task 1: Load one partition to Bronze and Silver layers in a single pass using our parser function"""
+    return write_bronze_and_silver(partition, start, end, workers=PARSE_WORKERS_PER_PARTITION)
 
-def task_silver(**context):
-    """Task 2: Load to Silver layer using our parser function"""
-    write_to_silver()
+def task_clean_source(**context):
+    """Task 1b: Remove the decompressed source once every partition is written"""
+    remove_plain_source()
 
-def task_database(**context):
-    """Task 3: Load to Database"""
+def task_silver(partition, expected_records, **context):
+    """Task 2: Validate one Silver partition written alongside Bronze, before it is loaded"""
+    validate_silver_partition(partition, expected_records)
+
+def task_prepare_database(**context):
+    """Task 3a: Clear the staging and lookup tables and load the lookup table"""
     # Get database connection
     postgres_hook = PostgresHook(postgres_conn_id='nhtsa_postgres')
     engine = postgres_hook.get_sqlalchemy_engine()
     
+    # Load lookup table - column names already match the table apart from case
+    # Arrow's multithreaded reader, with columnar strings instead of Python objects
+    lookup_df = pd.read_csv('/opt/airflow/data/lookup/nhtsa_lookup_file.csv', engine='pyarrow', dtype_backend='pyarrow')
+    lookup_df = lookup_df.astype({
+        'Vehicle_Type_ID': 'Int64',
+        'Body_Class_ID': 'Int64',
+        'Incomplete_Chassis': 'boolean',
+    })
+    lookup_df['Incomplete_Chassis'] = lookup_df['Incomplete_Chassis'].fillna(False)
+    lookup_df = lookup_df.rename(columns=str.lower)
+    
     with engine.connect() as conn:
         with conn.begin():
-            # Clear existing data
-            conn.execute(text("DELETE FROM processed_nhtsa_data"))
-            conn.execute(text("DELETE FROM nhtsa_lookup_table"))
+            # processed_nhtsa_data is rebuilt from silver on every run, so it doesn't need WAL -
+            # after a crash Postgres empties it and the next run reloads it.
+            # One-time migration for databases created before it was unlogged: the ALTER
+            # takes an exclusive lock, so it only runs while the table is still permanent
+            conn.execute(text("""
+                DO $$
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM pg_class
+                               WHERE oid = to_regclass('processed_nhtsa_data')
+                                 AND relpersistence = 'p') THEN
+                        ALTER TABLE processed_nhtsa_data SET UNLOGGED;
+                    END IF;
+                END $$;
+            """))
             
-            # Load processed data from silver layer
-            with open('/opt/airflow/data/silver/filtered_nhtsa_data.json', 'r') as f:
-                data = json.load(f)
+            # Shared staging table for the partition loads - unlogged like the table it feeds
+            conn.execute(text("""
+                CREATE UNLOGGED TABLE IF NOT EXISTS processed_nhtsa_data_staging (
+                    LIKE processed_nhtsa_data,
+                    load_partition INTEGER,
+                    load_order BIGINT
+                );
+            """))
             
-            for record in data:
-                # Convert data types
-                try:
-                    model_year = int(record['Model_Year']) if record['Model_Year'] else None
-                except (ValueError, TypeError):
-                    model_year = None
-                    
-                try:
-                    vehicle_type_id = int(record['Vehicle_Type_Id']) if record['Vehicle_Type_Id'] else None
-                except (ValueError, TypeError):
-                    vehicle_type_id = None
-                    
-                try:
-                    body_class_id = int(record['Body_Class_Id']) if record['Body_Class_Id'] else None
-                except (ValueError, TypeError):
-                    body_class_id = None
-                    
-                try:
-                    base_price = float(record['Base_Price']) if record['Base_Price'] else None
-                except (ValueError, TypeError):
-                    base_price = None
-                
-                # Insert record
-                insert_query = text("""
-                    INSERT INTO processed_nhtsa_data 
-                    (sent_vin, manufacturer_name, make, model, model_year, trim, 
-                     vehicle_type_id, body_class_id, base_price, ncsa_make, ncsa_model)
-                    VALUES (:sent_vin, :manufacturer_name, :make, :model, :model_year, :trim,
-                            :vehicle_type_id, :body_class_id, :base_price, :ncsa_make, :ncsa_model)
-                """)
-                
-                conn.execute(insert_query, {
-                    'sent_vin': record['Sent_VIN'],
-                    'manufacturer_name': record['Manufacturer_Name'],
-                    'make': record['Make'],
-                    'model': record['Model'],
-                    'model_year': model_year,
-                    'trim': record['TRIM'],
-                    'vehicle_type_id': vehicle_type_id,
-                    'body_class_id': body_class_id,
-                    'base_price': base_price,
-                    'ncsa_make': record['NCSA_Make'],
-                    'ncsa_model': record['NCSA_Model']
-                })
+            # Clear existing data - TRUNCATE drops the table files instead of deleting row by row
+            # (no foreign keys point at these tables, so no CASCADE needed).
+            # processed_nhtsa_data keeps the previous run's rows until the merge replaces them
+            conn.execute(text("TRUNCATE processed_nhtsa_data_staging, nhtsa_lookup_table RESTART IDENTITY"))
             
-            # Load lookup table
-            lookup_df = pd.read_csv('/opt/airflow/data/lookup/nhtsa_lookup_file.csv')
+            # Create the VIN key if the database predates it
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS processed_nhtsa_data_sent_vin_key
+                ON processed_nhtsa_data (sent_vin);
+            """))
             
-            for _, row in lookup_df.iterrows():
-                insert_lookup = text("""
-                    INSERT INTO nhtsa_lookup_table 
-                    (vehicle_type_id, vehicle_type, body_class_id, body_class, 
-                     lx_bodyclass_lvl1, lx_bodyclass_lvl2, incomplete_chassis)
-                    VALUES (:vehicle_type_id, :vehicle_type, :body_class_id, :body_class,
-                            :lx_bodyclass_lvl1, :lx_bodyclass_lvl2, :incomplete_chassis)
-                """)
-                
-                conn.execute(insert_lookup, {
-                    'vehicle_type_id': int(row['Vehicle_Type_ID']) if pd.notna(row['Vehicle_Type_ID']) else None,
-                    'vehicle_type': str(row['Vehicle_Type']) if pd.notna(row['Vehicle_Type']) else None,
-                    'body_class_id': int(row['Body_Class_ID']) if pd.notna(row['Body_Class_ID']) else None,
-                    'body_class': str(row['Body_Class']) if pd.notna(row['Body_Class']) else None,
-                    'lx_bodyclass_lvl1': str(row['LX_BodyClass_lvl1']) if pd.notna(row['LX_BodyClass_lvl1']) else None,
-                    'lx_bodyclass_lvl2': str(row['LX_BodyClass_lvl2']) if pd.notna(row['LX_BodyClass_lvl2']) else None,
-                    'incomplete_chassis': bool(row['Incomplete_Chassis']) if pd.notna(row['Incomplete_Chassis']) else False
-                })
-    
-    print("Database loading completed")
+            lookup_df.to_sql('nhtsa_lookup_table', conn, if_exists='append', index=False, method=psql_copy)
+    
+    print(f"Database prepared: {len(lookup_df)} lookup rows loaded")
 
-def task_load_to_gold(**context):
-    """Task 4: Load analytical results to Gold layer tables"""
+def task_database(partition, **context):
+    """Task 3b: Stage one silver partition in the Database"""
+    # Get database connection
+    postgres_hook = PostgresHook(postgres_conn_id='nhtsa_postgres')
+    engine = postgres_hook.get_sqlalchemy_engine()
+    
+    # Load processed data from this silver partition - Parquet columns are already typed
+    # (numbers as nullable ints/floats, strings as Arrow strings), so no conversion is needed
+    silver_file = os.path.join('/opt/airflow', SILVER_PART_FILE.format(partition))
+    df = pd.read_parquet(silver_file, dtype_backend='pyarrow')
+    df = df.rename(columns=SILVER_TO_DB_COLUMNS)
+    
+    # Keep the file order - partitions are consecutive pieces of the source, so
+    # (load_partition, load_order) is the position of the record in the source file
+    df['load_partition'] = partition
+    df['load_order'] = range(len(df))
+    
+    # All partitions stage into one shared table; parallel COPYs into it don't block each other
+    # and duplicate VINs are resolved once every partition is in (see task_merge_database)
+    with engine.connect() as conn:
+        with conn.begin():
+            df.to_sql('processed_nhtsa_data_staging', conn, if_exists='append', index=False, method=psql_copy)
     
+    print(f"Database staging completed for partition {partition}: {len(df)} records")
+
+def task_merge_database(**context):
+    """Task 3c: Move the staged partitions into processed_nhtsa_data, one record per VIN"""
     postgres_hook = PostgresHook(postgres_conn_id='nhtsa_postgres')
     engine = postgres_hook.get_sqlalchemy_engine()
     
     with engine.connect() as conn:
         with conn.begin():
-            # Create Gold layer tables
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS gold_top_vehicle_models (
-                    model_year INTEGER,
-                    make VARCHAR(50),
-                    model VARCHAR(100),
-                    vehicle_count INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
+            # Swap the table contents in one transaction - readers wait for the commit instead of
+            # seeing an empty table, and a run that fails before or during the merge leaves the
+            # previous rows in place
+            conn.execute(text("TRUNCATE processed_nhtsa_data"))
+            
+            # Keep the first record of each VIN in source file order, whichever partition
+            # finished loading first. Records without a VIN are all kept, stored as NULL
+            # so they don't collide with each other on the unique key
+            result = conn.execute(text("""
+                INSERT INTO processed_nhtsa_data 
+                (sent_vin, manufacturer_name, make, model, model_year, trim, 
+                 vehicle_type_id, body_class_id, base_price, ncsa_make, ncsa_model)
+                SELECT sent_vin, manufacturer_name, make, model, model_year, trim,
+                       vehicle_type_id, body_class_id, base_price, ncsa_make, ncsa_model
+                FROM (
+                    SELECT DISTINCT ON (sent_vin) *
+                    FROM processed_nhtsa_data_staging
+                    WHERE sent_vin != ''
+                    ORDER BY sent_vin, load_partition, load_order
+                ) first_per_vin
+                UNION ALL
+                SELECT NULL, manufacturer_name, make, model, model_year, trim,
+                       vehicle_type_id, body_class_id, base_price, ncsa_make, ncsa_model
+                FROM processed_nhtsa_data_staging
+                WHERE sent_vin IS NULL OR sent_vin = ''
             """))
             
+            conn.execute(text("TRUNCATE processed_nhtsa_data_staging"))
+    
+    print(f"Database loading completed: {result.rowcount} unique records")
+
+def task_create_indexes(**context):
+    """Task 4: Index and analyze the silver tables for the Gold layer queries"""
+    
+    postgres_hook = PostgresHook(postgres_conn_id='nhtsa_postgres')
+    engine = postgres_hook.get_sqlalchemy_engine()
+    
+    with engine.connect() as conn:
+        with conn.begin():
+            # Covering indexes for the Gold join/group-by - lets Postgres answer it from the indexes alone
             conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS gold_body_class_distribution (
-                    lx_bodyclass_lvl1 VARCHAR(50),
-                    bodysegment VARCHAR(50),
-                    vehicle_count INTEGER,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
+                CREATE INDEX IF NOT EXISTS processed_nhtsa_data_vehicle_body_idx
+                ON processed_nhtsa_data (vehicle_type_id, body_class_id) INCLUDE (sent_vin);
+            """))
+            # Unique as well: one lookup row per pair means the join never counts a VIN twice
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS nhtsa_lookup_table_vehicle_body_key
+                ON nhtsa_lookup_table (vehicle_type_id, body_class_id) INCLUDE (lx_bodyclass_lvl1, lx_bodyclass_lvl2);
+            """))
+    
+    # VACUUM can't run inside a transaction. It refreshes the visibility map (needed for
+    # index-only scans) and the planner statistics after the reload
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.execute(text("VACUUM (ANALYZE) processed_nhtsa_data"))
+        conn.execute(text("VACUUM (ANALYZE) nhtsa_lookup_table"))
+    
+    print("Indexes created and tables analyzed")
+
+def task_load_to_gold(**context):
+    """Task 5: Refresh analytical results in the Gold layer materialized views"""
+    
+    postgres_hook = PostgresHook(postgres_conn_id='nhtsa_postgres')
+    engine = postgres_hook.get_sqlalchemy_engine()
+    
+    with engine.connect() as conn:
+        with conn.begin():
+            # Older databases have the Gold layer as plain tables, or as views with a per-row
+            # created_at column - replace them with the current views
+            conn.execute(text("""
+                DO $$
+                BEGIN
+                    IF EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'gold_top_vehicle_models') THEN
+                        DROP TABLE gold_top_vehicle_models;
+                    END IF;
+                    IF EXISTS (SELECT 1 FROM pg_tables WHERE tablename = 'gold_body_class_distribution') THEN
+                        DROP TABLE gold_body_class_distribution;
+                    END IF;
+                    IF EXISTS (SELECT 1 FROM pg_attribute
+                               WHERE attrelid = to_regclass('gold_top_vehicle_models')
+                                 AND attname = 'created_at' AND NOT attisdropped) THEN
+                        DROP MATERIALIZED VIEW gold_top_vehicle_models;
+                    END IF;
+                    IF EXISTS (SELECT 1 FROM pg_attribute
+                               WHERE attrelid = to_regclass('gold_body_class_distribution')
+                                 AND attname = 'created_at' AND NOT attisdropped) THEN
+                        DROP MATERIALIZED VIEW gold_body_class_distribution;
+                    END IF;
+                END $$;
             """))
             
-            # Clear existing data
-            conn.execute(text("DELETE FROM gold_top_vehicle_models"))
-            conn.execute(text("DELETE FROM gold_body_class_distribution"))
-            
-            # Load Gold Table 1: Top 10 most common vehicles
-            gold_query1 = """
-                INSERT INTO gold_top_vehicle_models (model_year, make, model, vehicle_count)
-                SELECT model_year, make, model, COUNT(DISTINCT sent_vin) as vehicle_count
+            # sent_vin is unique in processed_nhtsa_data, so COUNT(*) is the distinct VIN count
+            # Gold View 1: Top 10 most common vehicles
+            conn.execute(text("""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS gold_top_vehicle_models AS
+                SELECT model_year, make, model,
+                       COUNT(*)::INTEGER as vehicle_count
                 FROM processed_nhtsa_data
                 WHERE sent_vin IS NOT NULL AND sent_vin != ''
                 GROUP BY model_year, make, model
                 ORDER BY vehicle_count DESC
                 LIMIT 10;
-            """
-            conn.execute(text(gold_query1))
+            """))
             
-            # Load Gold Table 2: Body class distribution
-            gold_query2 = """
-                INSERT INTO gold_body_class_distribution (lx_bodyclass_lvl1, bodysegment, vehicle_count)
+            # Gold View 2: Body class distribution
+            conn.execute(text("""
+                CREATE MATERIALIZED VIEW IF NOT EXISTS gold_body_class_distribution AS
                 SELECT 
                     l.lx_bodyclass_lvl1,
                     l.lx_bodyclass_lvl2 as bodysegment,
-                    COUNT(DISTINCT p.sent_vin) as vehicle_count
+                    COUNT(*)::INTEGER as vehicle_count
                 FROM processed_nhtsa_data p
                 JOIN nhtsa_lookup_table l 
                     ON p.vehicle_type_id = l.vehicle_type_id 
@@ -193,8 +306,33 @@ def task_load_to_gold(**context):
                     AND NOT (l.lx_bodyclass_lvl1 = 'PASSENGER CAR' AND l.lx_bodyclass_lvl2 = 'CONVERTIBLE')
                 GROUP BY l.lx_bodyclass_lvl1, l.lx_bodyclass_lvl2
                 ORDER BY l.lx_bodyclass_lvl1, vehicle_count DESC;
-            """
-            conn.execute(text(gold_query2))
+            """))
+            
+            # REFRESH ... CONCURRENTLY needs a unique index - the group-by columns are unique
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS gold_top_vehicle_models_key
+                ON gold_top_vehicle_models (model_year, make, model);
+            """))
+            conn.execute(text("""
+                CREATE UNIQUE INDEX IF NOT EXISTS gold_body_class_distribution_key
+                ON gold_body_class_distribution (lx_bodyclass_lvl1, bodysegment);
+            """))
+            
+            # Readers keep seeing the previous results until the refresh commits
+            conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY gold_top_vehicle_models"))
+            conn.execute(text("REFRESH MATERIALIZED VIEW CONCURRENTLY gold_body_class_distribution"))
+            
+            # The refresh time goes on the views instead of in every row - a timestamp column
+            # would change every row on each run, so the concurrent refresh could never keep one
+            conn.execute(text("""
+                DO $$
+                BEGIN
+                    EXECUTE format('COMMENT ON MATERIALIZED VIEW gold_top_vehicle_models IS %L',
+                                   'Refreshed at ' || now());
+                    EXECUTE format('COMMENT ON MATERIALIZED VIEW gold_body_class_distribution IS %L',
+                                   'Refreshed at ' || now());
+                END $$;
+            """))
             
             # Show some results - just for verification
             result1 = conn.execute(text("SELECT * FROM gold_top_vehicle_models ORDER BY vehicle_count DESC LIMIT 5"))
@@ -205,29 +343,82 @@ def task_load_to_gold(**context):
     print("Gold layer loaded successfully")
 
 # Define the tasks
-task1_bronze = PythonOperator(
-    task_id='load_to_bronze',
-    python_callable=task_bronze,
+task0_plan = PythonOperator(
+    task_id='plan_bronze_partitions',
+    python_callable=task_plan_bronze,
+    dag=dag,
+)
+
+task3_prepare = PythonOperator(
+    task_id='prepare_database',
+    python_callable=task_prepare_database,
+    dag=dag,
+)
+
+# One bronze -> database chain per partition, mapped over the planned partitions:
+# a partition starts loading as soon as its own silver file is written,
+# while the other partitions are still being parsed
+@task_group(group_id='partitions', dag=dag)
+def partition_pipeline(partition, start, end):
+    task1_bronze = PythonOperator(
+        task_id='load_to_bronze',
+        python_callable=task_bronze,
+        op_kwargs={'partition': partition, 'start': start, 'end': end},
+        pool='nhtsa_cpu',
+        dag=dag,
+    )
+    
+    # Checks the partition's Parquet file against the record count bronze returned
+    task2_silver = PythonOperator(
+        task_id='load_to_silver',
+        python_callable=task_silver,
+        op_kwargs={'partition': partition, 'expected_records': task1_bronze.output},
+        dag=dag,
+    )
+    
+    # The small nhtsa_db pool caps Postgres concurrency
+    task3_database = PythonOperator(
+        task_id='load_to_database',
+        python_callable=task_database,
+        op_kwargs={'partition': partition},
+        pool='nhtsa_db',
+        dag=dag,
+    )
+    
+    # Loads wait for their own silver check and for the tables to be cleared,
+    # not for the other partitions
+    task1_bronze >> task2_silver
+    [task2_silver, task3_prepare] >> task3_database
+
+task1_partitions = partition_pipeline.expand_kwargs(task0_plan.output)
+
+task1_clean = PythonOperator(
+    task_id='clean_source',
+    python_callable=task_clean_source,
     dag=dag,
 )
 
-task2_silver = PythonOperator(
-    task_id='load_to_silver',
-    python_callable=task_silver,
+task3_merge = PythonOperator(
+    task_id='merge_database',
+    python_callable=task_merge_database,
     dag=dag,
 )
 
-task3_database = PythonOperator(
-    task_id='load_to_database',
-    python_callable=task_database,
+task4_indexes = PythonOperator(
+    task_id='create_indexes',
+    python_callable=task_create_indexes,
     dag=dag,
 )
 
-task4_gold = PythonOperator(
+task5_gold = PythonOperator(
     task_id='load_to_gold',
     python_callable=task_load_to_gold,
     dag=dag,
 )
 
 # Set task dependencies
-task1_bronze >> task2_silver >> task3_database >> task4_gold
\ No newline at end of file
+# Preparing the database only needs the DB, so it runs alongside the bronze partitions
+# Each partition's silver check runs inside its group, before that partition is loaded
+task0_plan >> task3_prepare
+task1_partitions >> task3_merge >> task4_indexes >> task5_gold
+task1_partitions >> task1_clean
@@ -2,7 +2,9 @@
 -- Simple schema with just the 2 required tables
 
 -- Table 1: Main processed NHTSA data
-CREATE TABLE IF NOT EXISTS processed_nhtsa_data (
+-- UNLOGGED: the table is fully reloaded from the silver layer on every DAG run,
+-- so it skips WAL. After a database crash Postgres empties it - rerun the DAG to rebuild
+CREATE UNLOGGED TABLE IF NOT EXISTS processed_nhtsa_data (
     sent_vin VARCHAR(20),
     manufacturer_name VARCHAR(100),
     make VARCHAR(50),
@@ -13,7 +15,17 @@ CREATE TABLE IF NOT EXISTS processed_nhtsa_data (
     body_class_id INTEGER,
     base_price FLOAT,
     ncsa_make VARCHAR(50),
-    ncsa_model VARCHAR(100)
+    ncsa_model VARCHAR(100),
+    -- The load keeps the first record per VIN (in source order) from the staging table
+    CONSTRAINT processed_nhtsa_data_sent_vin_key UNIQUE (sent_vin)
+);
+
+-- Staging for the parallel partition loads: (load_partition, load_order) is the
+-- record's position in the source file, used to pick the first record per VIN
+CREATE UNLOGGED TABLE IF NOT EXISTS processed_nhtsa_data_staging (
+    LIKE processed_nhtsa_data,
+    load_partition INTEGER,
+    load_order BIGINT
 );
 
 -- Table 2: NHTSA lookup table
@@ -27,20 +39,39 @@ CREATE TABLE IF NOT EXISTS nhtsa_lookup_table (
     incomplete_chassis BOOLEAN
 );
 
--- Table 3: Gold layer - Top vehicle models (analytical results)
-CREATE TABLE IF NOT EXISTS gold_top_vehicle_models (
-    model_year INTEGER,
-    make VARCHAR(50),
-    model VARCHAR(100),
-    vehicle_count INTEGER,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+-- Gold views count rows: sent_vin is unique in processed_nhtsa_data and the
+-- lookup table has one row per (vehicle_type_id, body_class_id)
 
--- Table 4: Gold layer - Body class distribution (analytical results)
-CREATE TABLE IF NOT EXISTS gold_body_class_distribution (
-    lx_bodyclass_lvl1 VARCHAR(50),
-    bodysegment VARCHAR(50),
-    vehicle_count INTEGER,
-    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-);
+-- View 1: Gold layer - Top vehicle models (analytical results)
+-- Refreshed by the DAG with REFRESH MATERIALIZED VIEW CONCURRENTLY; the refresh time
+-- is kept in the view comment (obj_description), not in the rows, so unchanged rows are left alone
+CREATE MATERIALIZED VIEW IF NOT EXISTS gold_top_vehicle_models AS
+SELECT model_year, make, model,
+       COUNT(*)::INTEGER AS vehicle_count
+FROM processed_nhtsa_data
+WHERE sent_vin IS NOT NULL AND sent_vin != ''
+GROUP BY model_year, make, model
+ORDER BY vehicle_count DESC
+LIMIT 10;
+
+CREATE UNIQUE INDEX IF NOT EXISTS gold_top_vehicle_models_key
+ON gold_top_vehicle_models (model_year, make, model);
+
+-- View 2: Gold layer - Body class distribution (analytical results)
+CREATE MATERIALIZED VIEW IF NOT EXISTS gold_body_class_distribution AS
+SELECT
+    l.lx_bodyclass_lvl1,
+    l.lx_bodyclass_lvl2 AS bodysegment,
+    COUNT(*)::INTEGER AS vehicle_count
+FROM processed_nhtsa_data p
+JOIN nhtsa_lookup_table l
+    ON p.vehicle_type_id = l.vehicle_type_id
+    AND p.body_class_id = l.body_class_id
+WHERE p.sent_vin IS NOT NULL AND p.sent_vin != ''
+    AND l.lx_bodyclass_lvl1 NOT IN ('MOTORCYCLE', 'BUS')
+    AND NOT (l.lx_bodyclass_lvl1 = 'PASSENGER CAR' AND l.lx_bodyclass_lvl2 = 'CONVERTIBLE')
+GROUP BY l.lx_bodyclass_lvl1, l.lx_bodyclass_lvl2
+ORDER BY l.lx_bodyclass_lvl1, vehicle_count DESC;
 
+CREATE UNIQUE INDEX IF NOT EXISTS gold_body_class_distribution_key
+ON gold_body_class_distribution (lx_bodyclass_lvl1, bodysegment);
@@ -0,0 +1,70 @@
+# Field extraction for the NHTSA parser - the per-record hot path
+# Kept separate and fully typed so it can be compiled with mypyc (see setup.py)
+from typing import Any, Dict, Final, List, Tuple
+
+# Silver record structure - extract_vehicle_data returns values in this order
+FIELDS: Final = (
+    "Sent_VIN",
+    "Manufacturer_Name",
+    "Make",
+    "Model",
+    "Model_Year",
+    "TRIM",
+    "Vehicle_Type_Id",
+    "Body_Class_Id",
+    "Base_Price",
+    "NCSA_Make",
+    "NCSA_Model",
+)
+
+# Empty record template - copied into a list per record, filled in positionally
+_EMPTY_VALUES: Final = ("",) * len(FIELDS)
+
+# Map the NHTSA variable names to what we need
+FIELD_MAPPING: Final = {
+    "Manufacturer Name": "Manufacturer_Name",
+    "Make": "Make",
+    "Model": "Model",
+    "Model Year": "Model_Year",
+    "Trim": "TRIM",
+    "Vehicle Type": "Vehicle_Type_Id",
+    "Body Class": "Body_Class_Id",
+    "Base Price ($)": "Base_Price",
+    "NCSA Make": "NCSA_Make",
+    "NCSA Model": "NCSA_Model",
+}
+
+# For ID fields, use ValueId; for text fields, use Value
+# Took me a while to figure this out
+ID_FIELDS: Final = frozenset({"Vehicle Type", "Body Class"})
+
+# Precomputed per variable: (position in FIELDS, key to read from the result)
+FIELD_IDX: Final[Dict[str, Tuple[int, str]]] = {
+    variable: (FIELDS.index(field), "ValueId" if variable in ID_FIELDS else "Value")
+    for variable, field in FIELD_MAPPING.items()
+}
+
+def extract_vehicle_data(data: Dict[str, Any]) -> Tuple[str, ...]:
+    """Extract the required vehicle data fields from a single NHTSA record
+    
+    Returns a tuple of values in FIELDS order
+    """
+    values: List[str] = list(_EMPTY_VALUES)
+    
+    # Extract VIN from SearchCriteria - this was tricky to figure out
+    # rpartition keeps the text after the last "VIN:" (same as split()[-1]) without building a list
+    search_criteria: str = data.get("SearchCriteria", "") or ""
+    _, sep, vin_part = search_criteria.rpartition("VIN:")
+    if sep:
+        vin_part = vin_part.strip()
+        if len(vin_part) >= 11:
+            values[0] = vin_part[:11]
+    
+    # Go through all the results and extract what we need
+    for result in data.get("Results", []):
+        target = FIELD_IDX.get(result.get("Variable", "") or "")
+        if target is not None:
+            index, key = target
+            values[index] = result.get(key, "") or ""
+    
+    return tuple(values)
@@ -1,147 +1,270 @@
 # Basic imports - nothing fancy here
+import glob
 import gzip
-import json
 import os
+import shutil
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import orjson
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# Multithreaded gzip decoding is optional - plain gzip works the same, just single-threaded
+try:
+    import pgzip
+except ImportError:
+    pgzip = None
+
+# Field extraction lives in its own module so it can be compiled with mypyc (see setup.py);
+# the compiled extension is picked up automatically when built, else the .py is used
+from nhtsa_extract import FIELDS, extract_vehicle_data
 
 # File paths - hardcoded for simplicity
 SOURCE_FILE = "data/source/nhtsa_file.jsonl.gz"
-BRONZE_FILE = "data/bronze/complete_nhtsa_data.json"
-SILVER_FILE = "data/silver/filtered_nhtsa_data.json"
-
-# Default record structure
-DEFAULT_RECORD = {
-    "Sent_VIN": "",
-    "Manufacturer_Name": "",
-    "Make": "",
-    "Model": "",
-    "Model_Year": "",
-    "TRIM": "",
-    "Vehicle_Type_Id": "",
-    "Body_Class_Id": "",
-    "Base_Price": "",
-    "NCSA_Make": "",
-    "NCSA_Model": "",
-}
-
-def read_source_data():
-    """Read the compressed file - had to figure out the format first"""
-    records = []
+BRONZE_DIR = "data/bronze"
+BRONZE_PART_FILE = BRONZE_DIR + "/part-{:05d}.jsonl"
+SILVER_DIR = "data/silver"
+SILVER_PART_FILE = SILVER_DIR + "/part-{:05d}.parquet"
+# The source decompressed once per run; each bronze/silver partition reads a byte range of it
+PLAIN_SOURCE_FILE = "data/source/nhtsa_file.jsonl"
+
+# Parallel parsing - source lines vary a lot in size (each holds a list of up to ~60 API
+# responses, a few hundred KB on average), so chunks are cut by bytes rather than line count
+# PARSE_WORKERS is the default for a single partition; callers running several partitions
+# at once pass a smaller workers count so they share the CPUs instead of oversubscribing them
+PARSE_WORKERS = os.cpu_count() or 1
+PARSE_CHUNK_BYTES = 2 * 2**20
+PENDING_CHUNKS_PER_WORKER = 2
+
+# Silver column types - numbers are typed here so the database load doesn't convert them
+INT_FIELDS = ("Model_Year", "Vehicle_Type_Id", "Body_Class_Id")
+SILVER_SCHEMA = pa.schema([
+    ("Sent_VIN", pa.string()),
+    ("Manufacturer_Name", pa.string()),
+    ("Make", pa.string()),
+    ("Model", pa.string()),
+    ("Model_Year", pa.int64()),
+    ("TRIM", pa.string()),
+    ("Vehicle_Type_Id", pa.int64()),
+    ("Body_Class_Id", pa.int64()),
+    ("Base_Price", pa.float64()),
+    ("NCSA_Make", pa.string()),
+    ("NCSA_Model", pa.string()),
+])
+
+# pgzip buffers the source in blocks of this size and decodes its members with a capped
+# thread count - each thread holds a decoded member in memory, so more CPUs don't mean more threads
+DECOMPRESS_THREADS = min(8, PARSE_WORKERS)
+DECOMPRESS_BLOCK_SIZE = 2 * 10**7
+# Block size for writing the decompressed source
+COPY_BLOCK_SIZE = 16 * 2**20
+
+def open_source():
+    """Open the compressed source file for binary reading - with pgzip threads when available"""
+    if pgzip is not None:
+        return pgzip.open(SOURCE_FILE, 'rb', thread=DECOMPRESS_THREADS, blocksize=DECOMPRESS_BLOCK_SIZE)
+    return gzip.open(SOURCE_FILE, 'rb')
+
+def to_nullable_int(series):
+    """Convert a column to nullable integers - anything that isn't a whole number becomes null"""
+    numbers = pd.to_numeric(series, errors='coerce')
+    return numbers.where(numbers == numbers.round()).astype('Int64')
+
+def to_silver_table(records):
+    """Build a typed Arrow table from extracted record tuples - numbers that don't parse become null"""
+    df = pd.DataFrame(records, columns=list(FIELDS))
+    for column in INT_FIELDS:
+        df[column] = to_nullable_int(df[column])
+    df["Base_Price"] = pd.to_numeric(df["Base_Price"], errors='coerce')
+    return pa.Table.from_pandas(df, schema=SILVER_SCHEMA, preserve_index=False)
+
+def process_lines(lines):
+    """Parse and extract a chunk of JSONL lines - runs in a worker process
+    
+    Returns the indices of the lines that parsed (for bronze) and their extracted records (for silver).
+    The caller already holds the raw lines, so only their positions are sent back
+    """
+    bronze_indices = []
+    silver_records = []
+    for index, line in enumerate(lines):
+        line = line.strip()
+        if not line:
+            continue
+            
+        try:
+            data = orjson.loads(line)
+        except orjson.JSONDecodeError as e:
+            # Skip bad lines - there might be some
+            continue
+            
+        bronze_indices.append(index)
+        # Sometimes it's a list, sometimes just one record
+        records = data if isinstance(data, list) else [data]
+        silver_records.extend(extract_vehicle_data(record) for record in records)
+    return bronze_indices, silver_records
+
+def iter_chunks(lines, chunk_bytes=PARSE_CHUNK_BYTES):
+    """Group lines into chunks of about chunk_bytes - a chunk always holds at least one line"""
+    chunk = []
+    size = 0
+    for line in lines:
+        chunk.append(line)
+        size += len(line)
+        if size >= chunk_bytes:
+            yield chunk
+            chunk = []
+            size = 0
+    if chunk:
+        yield chunk
+
+def iter_range_lines(file, start, end):
+    """Yield the lines of an open binary file from byte start up to byte end (a line boundary)"""
+    file.seek(start)
+    position = start
+    while end is None or position < end:
+        line = file.readline()
+        if not line:
+            break
+        position += len(line)
+        yield line
+
+def read_source_data(path, start=0, end=None, workers=PARSE_WORKERS):
+    """Read a byte range of a plain JSONL file in chunks of lines processed in parallel
+    
+    Yields (lines, bronze_indices, silver_records) per chunk, in file order.
+    start and end limit the read to one partition of the file (end is exclusive, None reads to the end)
+    """
+    max_pending = workers * PENDING_CHUNKS_PER_WORKER
     try:
-        with gzip.open(SOURCE_FILE, 'rt', encoding='utf-8') as file:
-            for line_num, line in enumerate(file, 1):
-                line = line.strip()
-                if not line:
-                    continue
-                    
-                try:
-                    data = json.loads(line)
-                    # Sometimes it's a list, sometimes just one record
-                    if isinstance(data, list):
-                        records.extend(data)
-                    else:
-                        records.append(data)
-                except json.JSONDecodeError as e:
-                    # Skip bad lines - there might be some
-                    continue
+        with open(path, 'rb') as file, ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = deque()
+            for chunk in iter_chunks(iter_range_lines(file, start, end)):
+                pending.append((chunk, pool.submit(process_lines, chunk)))
+                # Cap the chunks in flight so memory stays bounded on big files
+                # (about max_pending * PARSE_CHUNK_BYTES of raw lines)
+                if len(pending) >= max_pending:
+                    chunk, result = pending.popleft()
+                    yield (chunk, *result.result())
+            while pending:
+                chunk, result = pending.popleft()
+                yield (chunk, *result.result())
                     
     except FileNotFoundError:
-        print(f"Error: Could not find input file {SOURCE_FILE}")
+        print(f"Error: Could not find input file {path}")
         raise
     except Exception as e:
         print(f"Unexpected error reading source: {e}")
         raise
-        
-    return records
-
-def save_to_file(data, file_path, description):
-    """Save data to file with directory creation"""
-    os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-    print(f"{description}: {len(data)} records written to {file_path}")
-
-def write_to_bronze():
-    """Write complete raw data to bronze layer"""
-    # Just dump everything from source - no processing yet
-    records = read_source_data()
-    save_to_file(records, BRONZE_FILE, "Bronze stage completed")
-
-def write_to_silver():
-    """Write processed and deduplicated data to silver layer"""
-    # Read from bronze layer - this is the data lake pattern
-    try:
-        with open(BRONZE_FILE, 'r', encoding='utf-8') as f:
-            records = json.load(f)
-    except FileNotFoundError:
-        print(f"Error: Bronze file not found at {BRONZE_FILE}")
-        print("Run write_to_bronze() first to create the bronze layer")
-        raise
+
+def plan_partitions(num_partitions):
+    """Decompress the source once and split it into byte ranges for the bronze/silver partitions
     
-    processed_records = []
-    seen_vins = set()
+    The source is decompressed into one plain file, cut at line boundaries into num_partitions
+    ranges of about the same size - each bronze task then reads only its own range of that file.
+    Old partition files are removed first so nothing downstream picks up a stale one
+    """
+    old_parts = glob.glob(os.path.join(BRONZE_DIR, "part-*")) + glob.glob(os.path.join(SILVER_DIR, "part-*"))
+    for old_part in old_parts:
+        os.remove(old_part)
     
-    for record in records:
-        processed = extract_vehicle_data(record)
-        vin = processed["Sent_VIN"]
-        
-        # Only keep unique VINs - this is the deduplication part
-        if not vin or vin not in seen_vins:
-            if vin:
-                seen_vins.add(vin)
-            processed_records.append(processed)
+    with open_source() as source, open(PLAIN_SOURCE_FILE, 'wb') as plain:
+        shutil.copyfileobj(source, plain, COPY_BLOCK_SIZE)
     
-    save_to_file(processed_records, SILVER_FILE, "Silver stage completed")
+    total_size = os.path.getsize(PLAIN_SOURCE_FILE)
+    num_partitions = max(1, num_partitions)
+    partitions = []
+    with open(PLAIN_SOURCE_FILE, 'rb') as plain:
+        start = 0
+        for partition in range(num_partitions):
+            # Cut after the line that crosses this partition's share of the bytes
+            plain.seek(max(start, total_size * (partition + 1) // num_partitions - 1))
+            plain.readline()
+            end = plain.tell()
+            partitions.append({"partition": partition, "start": start, "end": end})
+            start = end
+    return partitions
+
+def remove_plain_source():
+    """Remove the decompressed source once every partition has been written"""
+    if os.path.exists(PLAIN_SOURCE_FILE):
+        os.remove(PLAIN_SOURCE_FILE)
 
-def extract_vehicle_data(data):
-    """Extract the required vehicle data fields from a single NHTSA record"""
-    record = DEFAULT_RECORD.copy()
+def write_bronze_and_silver(partition=0, start=0, end=None, workers=PARSE_WORKERS):
+    """Write one partition of the source to both bronze and silver layers in a single pass
     
-    # Extract VIN from SearchCriteria - this was tricky to figure out
-    search_criteria = data.get("SearchCriteria", "")
-    if search_criteria and "VIN:" in search_criteria:
-        vin_part = search_criteria.split("VIN:")[-1].strip()
-        if len(vin_part) >= 11:
-            record["Sent_VIN"] = vin_part[:11]
+    Returns the number of records written to silver
+    """
+    # Bronze keeps the raw source lines as they are - no processing, no re-encoding
+    # Silver gets the extracted fields; duplicate VINs are dropped by the database when
+    # the staged partitions are merged (DISTINCT ON sent_vin in task_merge_database),
+    # so no deduplication pass is needed here
+    # Bronze is JSON lines, silver is typed Parquet; both are written chunk by chunk as they are read
+    bronze_file = BRONZE_PART_FILE.format(partition)
+    silver_file = SILVER_PART_FILE.format(partition)
+    os.makedirs(os.path.dirname(bronze_file), exist_ok=True)
+    os.makedirs(os.path.dirname(silver_file), exist_ok=True)
     
-    # Map the field names to what we need
-    field_mapping = {
-        "Manufacturer Name": "Manufacturer_Name",
-        "Make": "Make", 
-        "Model": "Model",
-        "Model Year": "Model_Year",
-        "Trim": "TRIM",
-        "Vehicle Type": "Vehicle_Type_Id",
-        "Body Class": "Body_Class_Id",
-        "Base Price ($)": "Base_Price",
-        "NCSA Make": "NCSA_Make",
-        "NCSA Model": "NCSA_Model"
-    }
+    bronze_count = 0
+    silver_count = 0
+    with open(bronze_file, 'wb') as bronze, pq.ParquetWriter(silver_file, SILVER_SCHEMA, compression='zstd') as silver:
+        for lines, bronze_indices, records in read_source_data(PLAIN_SOURCE_FILE, start, end, workers):
+            for index in bronze_indices:
+                bronze.write(lines[index].strip())
+                bronze.write(b'\n')
+            silver.write_table(to_silver_table(records))
+            bronze_count += len(bronze_indices)
+            silver_count += len(records)
+    print(f"Bronze stage completed: {bronze_count} lines written to {bronze_file}")
+    print(f"Silver stage completed: {silver_count} records written to {silver_file}")
+    return silver_count
+
+def validate_silver_partition(partition, expected_records=None):
+    """Check that one silver partition exists and holds the records written for it"""
+    silver_file = SILVER_PART_FILE.format(partition)
+    if not os.path.exists(silver_file):
+        raise FileNotFoundError(f"Silver partition missing: {silver_file}")
     
-    # Go through all the results and extract what we need
-    for result in data.get("Results", []):
-        variable = result.get("Variable", "")
-        if variable in field_mapping:
-            # For ID fields, use ValueId; for text fields, use Value
-            # Took me a while to figure this out
-            if variable in ["Vehicle Type", "Body Class"]:
-                record[field_mapping[variable]] = result.get("ValueId", "") or ""
-            else:
-                record[field_mapping[variable]] = result.get("Value", "") or ""
+    num_rows = pq.read_metadata(silver_file).num_rows
+    if expected_records is not None and num_rows != expected_records:
+        raise ValueError(f"Silver partition {silver_file} has {num_rows} records, expected {expected_records}")
+    print(f"Silver partition validated: {num_rows} records in {silver_file}")
+    return num_rows
+
+def validate_silver():
+    """Check that every bronze partition has its silver partition"""
+    bronze_files = sorted(glob.glob(os.path.join(BRONZE_DIR, "part-*.jsonl")))
+    if not bronze_files:
+        print(f"Error: No bronze partitions found in {BRONZE_DIR}")
+        print("Run write_bronze_and_silver() first to create the bronze and silver layers")
+        raise FileNotFoundError(f"No bronze partitions found in {BRONZE_DIR}")
     
-    return record
+    total = 0
+    for bronze_file in bronze_files:
+        partition = int(os.path.basename(bronze_file)[len("part-"):-len(".jsonl")])
+        silver_file = SILVER_PART_FILE.format(partition)
+        if not os.path.exists(silver_file):
+            raise FileNotFoundError(f"Silver partition missing for {bronze_file}: {silver_file}")
+        total += pq.read_metadata(silver_file).num_rows
+    print(f"Silver layer validated: {total} records in {len(bronze_files)} partitions")
 
 # Backward compatibility functions for Airflow DAG
 def parse_nhtsa_file():
-    """Legacy function - redirects to write_to_silver for backward compatibility"""
-    write_to_silver()
+    """Legacy function - runs the whole source as one bronze/silver partition"""
+    for partition in plan_partitions(1):
+        write_bronze_and_silver(**partition)
+    remove_plain_source()
 
 # Main execution
 if __name__ == "__main__":
     print("Starting NHTSA data pipeline...")
     
     try:
-        write_to_bronze()
-        write_to_silver()
+        for partition in plan_partitions(1):
+            write_bronze_and_silver(**partition)
+        remove_plain_source()
+        validate_silver()
         print("All pipeline stages completed!")
     except Exception as e:
         print(f"Pipeline failed: {e}")
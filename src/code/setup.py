@@ -0,0 +1,10 @@
+# Optional build step - compiles the extraction hot path with mypyc
+# Run from this directory: python setup.py build_ext --inplace
+# (needs mypy and a C compiler). Without it nhtsa_extract.py runs as plain Python
+from setuptools import setup
+from mypyc.build import mypycify
+
+setup(
+    name="nhtsa_extract",
+    ext_modules=mypycify(["nhtsa_extract.py"]),
+)